@@ -1,17 +1,32 @@
 from flask import Flask, render_template, jsonify, request, flash, redirect, url_for, session
 import os
 import subprocess
-from crontab import CronTab
+import threading
 import json
 import logging
 from pathlib import Path
-from typing import Dict, List, Optional, Union, Tuple
+from typing import Dict, List, Optional, Set, Union, Tuple
 from dataclasses import dataclass
 import sys
+import tempfile
+import time
 from functools import wraps
 from dotenv import load_dotenv, dotenv_values
 from datetime import timedelta
 
+# orjson is optional, standard json is used when it is not installed
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode('utf-8')
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj, indent=2)
+
 @dataclass
 class ScriptInfo:
     name: str
@@ -20,6 +35,11 @@ class ScriptInfo:
     status: str = "Synchronizační skript nebyl nalezen"
     enabled: bool = False
 
+# A script that is already running can't be started again until it finishes.
+# The guard is per process, separate gunicorn workers don't see each other's runs
+_running_scripts: Set[str] = set()
+_running_scripts_lock = threading.Lock()
+
 class SyncManager:
     SCHEDULE_OPTIONS = {
         "Nikdy": "",
@@ -29,10 +49,20 @@ class SyncManager:
         "Jednou měsíčně": "0 0 1 * *",
         "Jednou ročně": "0 0 1 1 *"
     }
+    # Reverse lookup of schedule names by their cron expressions
+    SCHEDULE_NAMES = {expr: name for name, expr in SCHEDULE_OPTIONS.items()}
+
+    # Results of script existence checks are shared by requests for a short time,
+    # keys are absolute script paths and values are (check time, exists).
+    # Missing scripts are remembered longer, a wrong folder won't appear on its own
+    STAT_CACHE_TTL = 2.0
+    NEGATIVE_STAT_CACHE_TTL = 10.0
+    _stat_cache: Dict[str, Tuple[float, bool]] = {}
 
     def __init__(self):
         self.logger = self._setup_logging()
         self.scripts_folder = str(Path(__file__).parent)
+        self.scripts_base = Path(os.path.abspath(self.scripts_folder))
         
         self.config_folder = os.path.join(self.scripts_folder, 'config')
         os.makedirs(self.config_folder, exist_ok=True)
@@ -42,6 +72,8 @@ class SyncManager:
         # Load scripts configuration
         self.SCRIPTS = self._load_scripts_config()
         
+        # Contents of the plan config file as last read or written, unchanged config isn't written again
+        self._last_config_bytes = None
         if not os.path.exists(self.config_file):
             self.config = self._remove_old_cron_commands()
             self.save_config()
@@ -57,7 +89,7 @@ class SyncManager:
         
             # Explicitly specify UTF-8 encoding
             with open(self.scripts_config_file, 'r', encoding='utf-8') as f:
-                config_data = json.load(f)
+                config_data = _json_loads(f.read())
                 
             if not isinstance(config_data, dict) or 'scripts' not in config_data:
                 raise ValueError("Neplatný formát konfiguračního souboru: chybí klíč 'scripts'")
@@ -87,9 +119,11 @@ class SyncManager:
     def _load_plan_config(self) -> dict:
         # Loads schedule plans for scripts
         try:
-            with open(self.config_file, 'r') as f:
-                config = json.load(f)
-                return config
+            with open(self.config_file, 'rb') as f:
+                data = f.read()
+            config = _json_loads(data)
+            self._last_config_bytes = data
+            return config
         except Exception as e:
             self.logger.error(f"Failed to load config: {e}")
             raise ValueError(f"Chyba při hledání konfigurace: {e}.")
@@ -126,21 +160,17 @@ class SyncManager:
         config = {}
         
         try:
+            # Crontab is imported only when schedules are changed, not with every page load
+            from crontab import CronTab
             cron = CronTab(user=True)
             for script in self.SCRIPTS:
-                script_path = os.path.abspath(os.path.join(
-                    self.scripts_folder,
-                    script.subfolder,
-                    script.name
-                ))
-                self.logger.info(f"Checking for cron jobs with path: {script_path}")
+                self.logger.info(f"Checking for cron jobs of script: {script.name}")
                 
-                # Remove any existing jobs for this script
-                for job in cron:
-                    if script_path in str(job.command) and "sync_manager" in str(job.comment):
-                        self.logger.info(f"Found matching job: {job.command}")
-                        cron.remove(job)
-                        self.logger.info(f"Removed existing cron job for {script.name}")
+                # Remove any existing jobs for this script, they are found by the comment they were created with
+                for job in list(cron.find_comment(f"sync_manager_{script.name}")):
+                    self.logger.info(f"Found matching job: {job.command}")
+                    cron.remove(job)
+                    self.logger.info(f"Removed existing cron job for {script.name}")
                 
                 config[f'schedule_{script.name}'] = ""
                 self.logger.info(f"Setting no schedule for {script.name}")
@@ -156,21 +186,49 @@ class SyncManager:
     def save_config(self) -> None:
         # Saves new schedules for the scripts in config
         try:
-            os.makedirs(os.path.dirname(self.config_file), exist_ok=True)
-            with open(self.config_file, 'w') as f:
-                json.dump(self.config, f, indent=2)
+            data = _json_dumps(self.config).encode('utf-8')
+            if data == self._last_config_bytes:
+                return
+            
+            config_dir = os.path.dirname(self.config_file)
+            os.makedirs(config_dir, exist_ok=True)
+            # Config is written to a temporary file and swapped in, so it's never left half written.
+            # Every save gets its own temporary file, concurrent saves don't overwrite each other's
+            fd, tmp_file = tempfile.mkstemp(dir=config_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                # Temporary file is created as 0600, config keeps its mode or gets the usual one for new files
+                try:
+                    mode = os.stat(self.config_file).st_mode & 0o777
+                except FileNotFoundError:
+                    umask = os.umask(0)
+                    os.umask(umask)
+                    mode = 0o666 & ~umask
+                os.chmod(tmp_file, mode)
+                os.replace(tmp_file, self.config_file)
+            except BaseException:
+                os.unlink(tmp_file)
+                raise
+            self._last_config_bytes = data
         except Exception as e:
             self.logger.error(f"Failed to save config: {e}")
             raise ValueError(f"Chyba při ukádání konfigurace {e}")
 
     def get_script_path(self, script: ScriptInfo) -> Tuple[str, bool]:
         # Returns absolute path to a script
-        full_path = os.path.abspath(os.path.join(
-            self.scripts_folder,
-            script.subfolder,
-            script.name
-        ))
-        exists = os.path.exists(full_path)
+        full_path = str(self.scripts_base / script.subfolder / script.name)
+        now = time.monotonic()
+        
+        cached = self._stat_cache.get(full_path)
+        if cached is not None:
+            checked_at, cached_exists = cached
+            ttl = self.STAT_CACHE_TTL if cached_exists else self.NEGATIVE_STAT_CACHE_TTL
+            if now - checked_at < ttl:
+                return full_path, cached_exists
+        
+        exists = os.path.isfile(full_path)
+        self._stat_cache[full_path] = (now, exists)
         return full_path, exists
 
     def validate_folder(self) -> Dict:
@@ -179,9 +237,37 @@ class SyncManager:
             scripts_status = []
             missing_scripts = []
             
+            # Scripts folder is listed first, so only subfolders that exist are listed afterwards
+            try:
+                with os.scandir(self.scripts_base) as entries:
+                    subfolder_paths = {entry.name: entry.path for entry in entries if entry.is_dir()}
+            except OSError:
+                subfolder_paths = {}
             
+            # Each subfolder is listed only once, scripts are then looked up in its listing
+            subfolder_files = {}
+            for subfolder in {script.subfolder for script in self.SCRIPTS}:
+                # Name is normalized first, so forms like "folder/" or "./folder" are found in the listing.
+                # Nested and relative subfolders aren't in the top level listing and are listed directly
+                key = os.path.normpath(subfolder)
+                if len(Path(key).parts) == 1 and key not in (os.curdir, os.pardir):
+                    subfolder_path = subfolder_paths.get(key)
+                else:
+                    subfolder_path = self.scripts_base / subfolder
+                
+                subfolder_files[subfolder] = set()
+                if subfolder_path is None:
+                    continue
+                try:
+                    with os.scandir(subfolder_path) as entries:
+                        subfolder_files[subfolder] = {entry.name for entry in entries if entry.is_file()}
+                except OSError:
+                    pass
+            
+            now = time.monotonic()
             for script in self.SCRIPTS:
-                script_path, exists = self.get_script_path(script)
+                exists = script.name in subfolder_files[script.subfolder]
+                self._stat_cache[str(self.scripts_base / script.subfolder / script.name)] = (now, exists)
                 status = "Synchronizační skript nalezen" if exists else "Synchronizační skript nebyl nalezen"
                 enabled = exists
                 
@@ -214,10 +300,7 @@ class SyncManager:
     def get_current_schedule(self, script_name: str) -> str:
         # Returns readable name for schedule of a script
         saved_cron = self.config.get(f'schedule_{script_name}', '')
-        for name, expr in self.SCHEDULE_OPTIONS.items():
-            if expr == saved_cron:
-                return name
-        return "Nikdy"
+        return self.SCHEDULE_NAMES.get(saved_cron, "Nikdy")
 
     def run_script(self, script_name: str) -> Dict:
         # Runs given script as subprocess
@@ -253,14 +336,24 @@ class SyncManager:
                     else:
                         env[ssl_var] = str(ssl_path)
             
-            process = subprocess.run(
-                [f"{venv_python}", script_path],
-                check=True,
-                capture_output=True,
-                text=True,
-                encoding='utf-8',
-                env=env
-            )
+            with _running_scripts_lock:
+                if script_name in _running_scripts:
+                    self.logger.error(f"Script {script_name} is already running")
+                    return {'success': False, 'message': f"Skript již běží: {script.display_name}"}
+                _running_scripts.add(script_name)
+            
+            try:
+                process = subprocess.run(
+                    [f"{venv_python}", script_path],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                    encoding='utf-8',
+                    env=env
+                )
+            finally:
+                with _running_scripts_lock:
+                    _running_scripts.discard(script_name)
             
             # Truncates too long messages
             output = process.stdout[:200] + "..." if len(process.stdout) > 200 else process.stdout
@@ -294,23 +387,40 @@ class SyncManager:
             raise ValueError(f"Skript nebyl nalezen: {script_path}. Skuste prohledat souborový system")
 
         try:
+            # Crontab is imported only when schedules are changed, not with every page load
+            from crontab import CronTab
             cron = CronTab(user=True)
             schedule = self.SCHEDULE_OPTIONS[schedule_name]
             
             venv_python = str(Path(self.scripts_folder) / 'venv' / 'bin' / 'python3')
+            command = f"{venv_python} {script_path}"
             
-            for job in cron:
-                if script_path in str(job.command):
-                    cron.remove(job)
-            
+            # Jobs of this script are found by the comment they were created with
+            jobs = list(cron.find_comment(f"sync_manager_{script_name}"))
             if schedule:
-                job = cron.new(
-                    command=f"{venv_python} {script_path}",
-                    comment=f"sync_manager_{script_name}"
-                )
-                job.setall(schedule)
+                unchanged = (len(jobs) == 1 and jobs[0].is_enabled()
+                             and jobs[0].command == command and jobs[0].slices == schedule)
+            else:
+                unchanged = not jobs
             
-            cron.write()
+            # Crontab is rewritten only when the schedule of the script really changed
+            if not unchanged:
+                if schedule and jobs:
+                    # Existing job is updated in place, duplicates are removed
+                    job = jobs.pop(0)
+                    job.set_command(command)
+                    job.setall(schedule)
+                    job.enable()
+                elif schedule:
+                    job = cron.new(
+                        command=command,
+                        comment=f"sync_manager_{script_name}"
+                    )
+                    job.setall(schedule)
+                for job in jobs:
+                    cron.remove(job)
+                
+                cron.write()
             
             self.config[f'schedule_{script_name}'] = schedule
             self.save_config()
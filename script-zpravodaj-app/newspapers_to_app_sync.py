@@ -1,42 +1,90 @@
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import db
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree
+from contextlib import closing
 import re
 import logging
 import os
 from datetime import datetime
 from pathlib import Path
 import configparser
+import hashlib
+import json
 import sys
-from validators import validate_link, validate_release, validate_year, validate_id
+from dataclasses import dataclass
+from functools import lru_cache
+from validators import validate_item, canonical_link
+
+# Czech month names mapping, both nominative and genitive forms
+_MONTHS = {
+    'leden': 1, 'ledna': 1, 'únor': 2, 'února': 2,
+    'březen': 3, 'března': 3, 'duben': 4, 'dubna': 4,
+    'květen': 5, 'května': 5, 'červen': 6, 'června': 6,
+    'červenec': 7, 'července': 7, 'srpen': 8, 'srpna': 8,
+    'září': 9, 'říjen': 10, 'října': 10,
+    'listopad': 11, 'listopadu': 11, 'prosinec': 12, 'prosince': 12
+}
+
+# Connect and read timeouts of requests to the website, so a stalled server can't hang the cron job
+_REQUEST_TIMEOUT = (3.05, 15)
+
+# Returned by fetch_newspapers when the page didn't change since the last synchronization
+NOT_MODIFIED = object()
+
+# Matches both "zpravodaj N/YYYY" and "zpravodaj MONTH YYYY" used in older publications
+_TITLE_RE = re.compile(
+    r'zpravodaj\s+(?:(?P<num>\d+)\s*/\s*(?P<y1>\d{4})|(?P<mon>[^\W\d_]+)\s+(?P<y2>\d{4}))',
+    re.IGNORECASE
+)
+
+# Compiled XPath checks run inside lxml, elements without a link are rejected before their text is built
+_HAS_LINK = etree.XPath('boolean(.//a/@href)')
+_ELEMENT_TEXT = etree.XPath('string()')
+
+@lru_cache(maxsize=1)
+def _get_firebase_app(credentials_path, database_url):
+    # Firebase app is set up once per process, the certificate isn't parsed again by later updaters.
+    # Firebase SDK is imported only when it is needed, not on import of this module
+    import firebase_admin
+    from firebase_admin import credentials
+    
+    if firebase_admin._apps:
+        return firebase_admin.get_app()
+    
+    if not credentials_path.exists():
+        raise FileNotFoundError(f"Credentials file not found at: {credentials_path}")
+    
+    cred = credentials.Certificate(str(credentials_path))
+    return firebase_admin.initialize_app(cred, {
+        'databaseURL': database_url
+    })
 
 """
 Newspaper class representing a release of Orechovsky zpravodaj. Validatates data before creation.
 """
+@dataclass(frozen=True)
 class NewspaperItem:
-    def __init__(self, id, link, release, year, logger):
-        self.logger = logger
-        
-        validated_year = validate_year(year, logger)
-        validated_release = validate_release(release, logger)
-        
-        if validated_year is None or validated_release is None:
-            raise ValueError("Invalid year or release number")
-            
-        validated_id = validate_id(id, validated_year, validated_release, logger)
-        if validated_id is None:
-            raise ValueError("Invalid ID format")
-            
-        validated_link = validate_link(link, logger)
-        if validated_link is None:
-            raise ValueError("Invalid link format or not a PDF file")
-        
-        self.id = validated_id
-        self.link = validated_link
-        self.release = validated_release
-        self.year = validated_year
+    # Slots are declared by hand, dataclass(slots=True) needs Python 3.10
+    __slots__ = ('id', 'link', 'release', 'year', 'id_str')
+
+    id: int
+    link: str
+    release: int
+    year: int
+
+    def __post_init__(self):
+        # Firebase keys are strings, so the key form of id is kept alongside it
+        object.__setattr__(self, 'id_str', str(self.id))
+
+    @classmethod
+    def create(cls, id, link, release, year, logger):
+        # Validates data and creates the newspaper from validated values
+        validated_year, validated_release, validated_id, validated_link = validate_item(
+            id, year, release, link, logger
+        )
+        # Links are stored in canonical form, so they compare equal to the stored ones in later runs
+        return cls(validated_id, canonical_link(validated_link), validated_release, validated_year)
 
     def to_dict(self):
         return {
@@ -51,23 +99,41 @@ Class used for synchronizing Orechov app database with releases of Orechovsky zp
 website of Orechov with use of provided API.
 """
 class NewspaperUpdater:
-    def __init__(self, config_path='config.txt'):
-        # Convert to Path object
-        config_path = Path(config_path)
-        
+    def __init__(self, config_path='config.txt', *, config=None, firebase_app=None, logger=None):
+        # Already prepared config, firebase app or logger can be passed in to skip their setup
         self.script_dir = Path(__file__).parent.absolute()
         
-        if not config_path.is_absolute():
-            config_path = self.script_dir / config_path
+        if config is None:
+            # Convert to Path object
+            config_path = Path(config_path)
+            
+            if not config_path.is_absolute():
+                config_path = self.script_dir / config_path
+
+            if not config_path.exists():
+                raise FileNotFoundError(f"Configuration file not found at: {config_path}")
 
-        if not config_path.exists():
-            raise FileNotFoundError(f"Configuration file not found at: {config_path}")
+            config = configparser.ConfigParser()
+            config.read(str(config_path))
 
-        self.config = configparser.ConfigParser()
-        self.config.read(str(config_path))
+        self.config = config
         self._load_configurations()
-        self.logger = self._setup_logging()
-        self._initialize_firebase()
+        self.logger = logger if logger is not None else self._setup_logging()
+        self.firebase_app = firebase_app if firebase_app is not None else self._initialize_firebase()
+        
+        # One session keeps the connection to the website alive between requests
+        self.session = requests.Session()
+        # Temporary server errors and dropped connections are retried with a short backoff
+        retries = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504),
+                        raise_on_status=False)
+        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+        self.session.mount('http://', HTTPAdapter(max_retries=retries))
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'User-Agent': 'orechov-sync/1.0'
+        })
+        self.fetched_etag = None
+        self.fetched_last_modified = None
 
     def _resolve_path(self, path_str):
         # Helper method to resolve paths based on whether they're absolute or relative
@@ -85,22 +151,35 @@ class NewspaperUpdater:
         self.newspapers_url = self.config['Application']['url']
         self.firebase_route = self.config['Application']['firebase_route']
         self.scrape_element = self.config['Application']['scrape_element']
+        self.encoding = self.config['Application'].get('encoding', 'utf-8')
 
         # Logs directory and file
         self.logs_directory = self._resolve_path(self.config['Logging']['directory'])
         self.log_filename = self.config['Logging']['filename']
+        # State of the last successful synchronization is kept next to the logs
+        self.sync_state_path = self.logs_directory / 'sync_state.json'
+
+    def _load_sync_state(self):
+        # Loads state of the last successful synchronization, missing or broken state is treated as empty
+        try:
+            with open(self.sync_state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            return state if isinstance(state, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save_sync_state(self, state):
+        # Saves state of the last successful synchronization, failure only means a full synchronization next time
+        try:
+            with open(self.sync_state_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, indent=2)
+        except OSError as e:
+            self.logger.error(f"Failed to save synchronization state: {str(e)}")
 
     def _initialize_firebase(self):
         # Function that initializes firebase service access
         try:
-            if not firebase_admin._apps:
-                if not self.credentials_path.exists():
-                    raise FileNotFoundError(f"Credentials file not found at: {self.credentials_path}")
-                
-                cred = credentials.Certificate(str(self.credentials_path))
-                firebase_admin.initialize_app(cred, {
-                    'databaseURL': self.database_url
-                })
+            return _get_firebase_app(self.credentials_path, self.database_url)
         except Exception as e:
             raise ValueError(f"Failure to initialize database connection: {str(e)}")
 
@@ -125,50 +204,29 @@ class NewspaperUpdater:
         except Exception as e:
             raise ValueError(f"Failure to set up logging for program: {e}")
 
-    def _parse_newspaper_item(self, li_element):
-        # Parse a single newspaper item from an HTML li element
+    def _parse_newspaper_item(self, li_element, raw_text=None):
+        # Parse a single newspaper item from an HTML li element, text of the element can be passed in if already built
         try:
-            link = li_element.find('a')['href']
-                
-            # Czech month names mapping
-            month_mapping = {
-                'leden': 1, 'ledna': 1, 'únor': 2, 'února': 2,
-                'březen': 3, 'března': 3, 'duben': 4, 'dubna': 4,
-                'květen': 5, 'května': 5, 'červen': 6, 'června': 6,
-                'červenec': 7, 'července': 7, 'srpen': 8, 'srpna': 8,
-                'září': 9, 'říjen': 10, 'října': 10,
-                'listopad': 11, 'listopadu': 11, 'prosinec': 12, 'prosince': 12
-            }
-                
+            link = li_element.find('.//a').get('href')
             
-            raw_text = li_element.text
+            if raw_text is None:
+                raw_text = _ELEMENT_TEXT(li_element)
             
             # Extract release number and year from the link text
-            match = re.search(r'zpravodaj (\d+)/(\d{4})', raw_text, re.IGNORECASE)
+            match = _TITLE_RE.search(raw_text)
             if match:
-                try:
-                    release = int(match.group(1))
-                    year = int(match.group(2))
-                    id = (year * 100) + release
-                    return NewspaperItem(id, link, release, year, self.logger)
-                except ValueError as e:
-                    self.logger.error(f"Invalid format in zpravodaj: {e}")
-                    return None
-                except Exception as e:
-                    self.logger.error(f"Failed to create NewspaperItem: {str(e)}")
-                    return None
-            
-            # Try second pattern: "zpravodaj MONTH YYYY" used in older publications
-            for month_name, month_num in month_mapping.items():
-                # Using word boundaries \b to match whole words
-                pattern = rf'zpravodaj\s+{month_name}\s+(\d{{4}})'
-                match = re.search(pattern, raw_text)
-                if match:
+                if match.group('num') is not None:
+                    release = int(match.group('num'))
+                    year = int(match.group('y1'))
+                else:
+                    # Use month number as release number
+                    release = _MONTHS.get(match.group('mon').lower())
+                    year = int(match.group('y2'))
+                
+                if release is not None:
                     try:
-                        year = int(match.group(1))
-                        release = month_num  # Use month number as release number
                         id = (year * 100) + release
-                        return NewspaperItem(id, link, release, year, self.logger)
+                        return NewspaperItem.create(id, link, release, year, self.logger)
                     except ValueError as e:
                         self.logger.error(f"Invalid format in zpravodaj: {e}")
                         return None
@@ -176,32 +234,64 @@ class NewspaperUpdater:
                         self.logger.error(f"Failed to create NewspaperItem: {str(e)}")
                         return None
             
-            self.logger.error(f"Couldn't parse {li_element.text}")
+            self.logger.error(f"Couldn't parse {raw_text}")
             
         except Exception as e:
-            self.logger.error(f"Error parsing newspaper item {li_element.text}: {str(e)}")
+            self.logger.error(f"Error parsing newspaper item {''.join(li_element.itertext())}: {str(e)}")
             return None
         
         return None
 
+    def _collect_newspaper_items(self, parser, newspaper_items):
+        # Parses newspaper items from elements completed by the parser so far
+        for _, li in parser.read_events():
+            # Take only newspaper items, text is built once and reused by the item parser
+            text = _ELEMENT_TEXT(li) if _HAS_LINK(li) else ''
+            if 'ořechovský zpravodaj ' in text.lower():
+                item = self._parse_newspaper_item(li, text)
+                if item:
+                    newspaper_items.append(item)
+            li.clear()
+            # Already processed siblings are dropped too, so the tree doesn't keep the whole page
+            while li.getprevious() is not None:
+                del li.getparent()[0]
+
     def fetch_newspapers(self):
         # Fetch and parse newspapers from the website
         try:
             self.logger.info(f"Fetching newspapers from {self.newspapers_url}")
-            response = requests.get(self.newspapers_url)
-            response.raise_for_status()
-            response.encoding = 'utf-8'
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
             newspaper_items = []
             
-            # Find all li elements containing newspaper links
-            for li in soup.find_all(self.scrape_element):
-                # Take only newspaper items
-                if 'ořechovský zpravodaj ' in li.text.lower():
-                    item = self._parse_newspaper_item(li)
-                    if item:
-                        newspaper_items.append(item)
+            # Page is parsed while it is downloaded, only scraped elements are reported by the parser.
+            # Encoding of the page is known, so no detection is done on the downloaded bytes
+            parser = etree.HTMLPullParser(events=('end',), tag=self.scrape_element, encoding=self.encoding)
+            
+            # Page is downloaded only when it changed since the last successful synchronization
+            # Both validators are sent, the website may support only one of them
+            headers = {}
+            state = self._load_sync_state()
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+            
+            with closing(self.session.get(self.newspapers_url, headers=headers,
+                                             stream=True, timeout=_REQUEST_TIMEOUT)) as response:
+                if response.status_code == 304:
+                    self.logger.info("Newspapers page was not modified since last synchronization")
+                    return NOT_MODIFIED
+                response.raise_for_status()
+                self.fetched_etag = response.headers.get('ETag')
+                self.fetched_last_modified = response.headers.get('Last-Modified')
+                for chunk in response.iter_content(65536):
+                    parser.feed(chunk)
+                    self._collect_newspaper_items(parser, newspaper_items)
+            try:
+                parser.close()
+            except etree.XMLSyntaxError:
+                # Raised only for an empty page, in which case there is nothing left to parse
+                pass
+            self._collect_newspaper_items(parser, newspaper_items)
             
             self.logger.info(f"Found {len(newspaper_items)} newspaper items")
             if len(newspaper_items) == 0:
@@ -218,11 +308,12 @@ class NewspaperUpdater:
     def get_existing_data(self):
         # Retrieve existing newspaper data from Firebase
         try:
-            ref = db.reference(self.firebase_route)
+            from firebase_admin import db
+            ref = db.reference(self.firebase_route, app=self.firebase_app)
             data = ref.get()
             
-            # Convert string keys to integers if they exist
-            return {int(k): v for k, v in data.items()} if data else {}
+            # Data is returned as read, keys stay the strings Firebase returns
+            return data or {}
             
         except Exception as e:
             self.logger.error(f"Error fetching existing data: {str(e)}")
@@ -231,32 +322,40 @@ class NewspaperUpdater:
     def compare_and_update(self, new_items, existing_data):
         # Compare and update newspaper data in Firebase
         try:
-            ref = db.reference(self.firebase_route)
-            new_dict = {item.id: item.to_dict() for item in new_items}
+            from firebase_admin import db
+            ref = db.reference(self.firebase_route, app=self.firebase_app)
+            # Only links of existing items are compared, they are taken out of the records once.
+            # Older records may hold another form of the same link, so stored links are made canonical too
+            existing_links = {id: canonical_link(item.get('link')) for id, item in existing_data.items()}
             
+            # All changes are collected into paths of one multi-location update
+            updates = {}
             changes_detected = False
             link_updates = []
             new_items_added = []
             
             # Check each new item
-            for id, new_item in new_dict.items():
-                if id in existing_data:
+            for item in new_items:
+                id = item.id_str
+                if id in existing_links:
                     # Check only for link changes in existing items
-                    if existing_data[id]['link'] != new_item['link']:
+                    old_link = existing_links[id]
+                    if old_link != item.link:
                         self.logger.info(f"Link change detected for newspaper {id}")
-                        self.logger.info(f"Old link: {existing_data[id]['link']}")
-                        self.logger.info(f"New link: {new_item['link']}")
-                        ref.child(str(id)).child('link').set(new_item['link'])
+                        self.logger.info(f"Old link: {old_link}")
+                        self.logger.info(f"New link: {item.link}")
+                        updates[f"{id}/link"] = item.link
                         changes_detected = True
                         link_updates.append(id)
                 else:
-                    # Add new item to database
+                    # Add new item to database, record is built only for items that are written
                     self.logger.info(f"New newspaper detected: {id}")
-                    ref.child(str(id)).set(new_item)
+                    updates[id] = item.to_dict()
                     changes_detected = True
                     new_items_added.append(id)
             
             if changes_detected:
+                ref.update(updates)
                 self.logger.info("Summary of changes:")
                 if link_updates:
                     self.logger.info(f"Updated links for newspapers: {link_updates}")
@@ -268,15 +367,34 @@ class NewspaperUpdater:
             self.logger.error(f"Unexpected error during data comparison: {str(e)}")
             raise
 
+    @staticmethod
+    def _items_digest(items):
+        # Digest of ids and links of newspapers, it changes only when something to synchronize changes
+        content = b''.join(f'{item.id}:{item.link};'.encode('utf-8') for item in sorted(items, key=lambda item: item.id))
+        return hashlib.blake2b(content, digest_size=16).hexdigest()
+
     def update(self):
         # Updates newspapers in app to match those on municipality website
         try:
             self.logger.info(f"Starting synchronization process for {self.firebase_route}")
             
             new_items = self.fetch_newspapers()
-            if new_items:
-                existing_data = self.get_existing_data()
-                self.compare_and_update(new_items, existing_data)
+            if new_items is NOT_MODIFIED:
+                self.logger.info("Synchronization skipped, no changes on website")
+            elif new_items:
+                state = self._load_sync_state()
+                digest = self._items_digest(new_items)
+                if state.get('items_digest') == digest:
+                    self.logger.info("No upstream change in newspapers, database was not read")
+                else:
+                    existing_data = self.get_existing_data()
+                    self.compare_and_update(new_items, existing_data)
+                    state['items_digest'] = digest
+                
+                # State is saved only after the database is updated, so failed runs are repeated
+                state['etag'] = self.fetched_etag
+                state['last_modified'] = self.fetched_last_modified
+                self._save_sync_state(state)
                 self.logger.info("Synchronization completed successfully")
             else:
                 self.logger.error("Failed to fetch newspapers data")
@@ -301,6 +419,8 @@ def main():
         updater.logger.error(f"Synchronization error: {str(e)}")
         print(f"Synchronizace selhala. Pro více informací si přečtěte záznamový soubor na adrese {updater.logs_directory / updater.log_filename}", file=sys.stderr)
         return 1
+    finally:
+        updater.session.close()
 
 if __name__ == "__main__":
     sys.exit(main())
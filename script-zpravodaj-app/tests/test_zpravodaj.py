@@ -1,15 +1,12 @@
 import unittest
-from unittest.mock import patch, Mock, MagicMock, mock_open
-import json
+from unittest.mock import patch, Mock
 from pathlib import Path
-import firebase_admin
-from firebase_admin import credentials, db
 import logging
 import sys
 import os
-from bs4 import BeautifulSoup
+import lxml.html
 import requests
-from datetime import datetime
+import tempfile
 from io import StringIO
 
 # We need to import files from parent directory
@@ -17,17 +14,13 @@ current_dir = Path(__file__).resolve().parent
 parent_dir = current_dir.parent
 sys.path.insert(0, str(parent_dir))
 
-from newspapers_to_app_sync import NewspaperUpdater, NewspaperItem
+from newspapers_to_app_sync import NewspaperUpdater, NewspaperItem, NOT_MODIFIED
 
 class TestNewspapers(unittest.TestCase):
     @classmethod
-    def setUpClass(cls):
-        # Configure logging to use a null handler
-        logging.getLogger('newspapers_sync').addHandler(logging.NullHandler())
-
-    def setUp(self):
-        # Mock config content
-        self.mock_config = {
+    def _build_mock_config(cls):
+        # Mock config content, logs directory points to the temporary directory of the test class
+        return {
             'Database': {
                 'database_url': 'mock://database.url',
                 'credentials_path': 'mock_credentials.json'
@@ -38,11 +31,36 @@ class TestNewspapers(unittest.TestCase):
                 'scrape_element': 'li'
             },
             'Logging': {
-                'directory': 'logs',
+                'directory': str(cls.test_dir),
                 'filename': 'test.log'
             }
         }
 
+    @classmethod
+    def setUpClass(cls):
+        # Sync state of tests is kept in a temporary directory, not next to the logs of the script
+        cls._tmp = tempfile.TemporaryDirectory()
+        cls.test_dir = Path(cls._tmp.name)
+
+        # Configure logging to use a null handler
+        cls.logger = logging.getLogger('newspapers_sync')
+        cls.logger.addHandler(logging.NullHandler())
+
+        # Updater shared by tests that don't modify its state, fetch tests create their own
+        cls.updater = cls._create_updater(cls._build_mock_config())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmp.cleanup()
+
+    @classmethod
+    def _create_updater(cls, config):
+        # Config, firebase app and logger are passed in, so no file, network or logging setup happens
+        return NewspaperUpdater(config=config, firebase_app=Mock(), logger=cls.logger)
+
+    def setUp(self):
+        self.mock_config = self._build_mock_config()
+
         # Sample HTML content for testing
         self.sample_html = """
         <ul>
@@ -53,50 +71,10 @@ class TestNewspapers(unittest.TestCase):
         </ul>
         """
 
-        # Setup config parser mock
-        self.config_patcher = patch('configparser.ConfigParser')
-        self.mock_config_parser = self.config_patcher.start()
-        mock_parser = self.mock_config_parser.return_value
-        mock_parser.__getitem__.side_effect = self.mock_config.__getitem__
-        mock_parser.read.return_value = None
-
-        # Setup path exists mock
-        self.path_exists_patcher = patch.object(Path, 'exists', return_value=True)
-        self.path_exists_patcher.start()
-
-        # Setup mkdir mock
-        self.mkdir_patcher = patch.object(Path, 'mkdir')
-        self.mkdir_patcher.start()
-
-        # Setup logging mock
-        self.logging_patcher = patch('logging.FileHandler')
-        mock_handler = self.logging_patcher.start()
-        mock_handler.return_value = logging.NullHandler()
-
-        # Setup firebase mock
-        self.firebase_patcher = patch('firebase_admin.initialize_app')
-        self.firebase_patcher.start()
-
-        # Mock credentials
-        self.cred_patcher = patch('firebase_admin.credentials.Certificate')
-        self.cred_patcher.start()
-        
-        self.makedirs_patcher = patch('os.makedirs')
-        self.makedirs_patcher.start()
-
-    def tearDown(self):
-        self.config_patcher.stop()
-        self.path_exists_patcher.stop()
-        self.mkdir_patcher.stop()
-        self.logging_patcher.stop()
-        self.firebase_patcher.stop()
-        self.cred_patcher.stop()
-        self.makedirs_patcher.stop()
-
     def test_parse_newspaper_item_valid_numeric(self):
-        updater = NewspaperUpdater()
-        soup = BeautifulSoup('<li><a href="/zpravodaj2024_01.pdf">Ořechovský zpravodaj 1/2024</a></li>', 'html.parser')
-        item = updater._parse_newspaper_item(soup.li)
+        updater = self.updater
+        li = lxml.html.fromstring('<li><a href="/zpravodaj2024_01.pdf">Ořechovský zpravodaj 1/2024</a></li>')
+        item = updater._parse_newspaper_item(li)
         
         self.assertIsNotNone(item)
         self.assertEqual(item.year, 2024)
@@ -105,9 +83,9 @@ class TestNewspapers(unittest.TestCase):
         self.assertEqual(item.link, 'https://www.orechovubrna.cz/zpravodaj2024_01.pdf')
 
     def test_parse_newspaper_item_valid_month(self):
-        updater = NewspaperUpdater()
-        soup = BeautifulSoup('<li><a href="/zpravodaj_brezen_2023.pdf">Ořechovský zpravodaj březen 2023</a></li>', 'html.parser')
-        item = updater._parse_newspaper_item(soup.li)
+        updater = self.updater
+        li = lxml.html.fromstring('<li><a href="/zpravodaj_brezen_2023.pdf">Ořechovský zpravodaj březen 2023</a></li>')
+        item = updater._parse_newspaper_item(li)
         
         self.assertIsNotNone(item)
         self.assertEqual(item.year, 2023)
@@ -116,15 +94,15 @@ class TestNewspapers(unittest.TestCase):
         self.assertEqual(item.link, 'https://www.orechovubrna.cz/zpravodaj_brezen_2023.pdf')
 
     def test_parse_newspaper_item_invalid(self):
-        updater = NewspaperUpdater()
-        soup = BeautifulSoup('<li><a href="/other.pdf">Some other document</a></li>', 'html.parser')
-        item = updater._parse_newspaper_item(soup.li)
+        updater = self.updater
+        li = lxml.html.fromstring('<li><a href="/other.pdf">Some other document</a></li>')
+        item = updater._parse_newspaper_item(li)
         
         self.assertIsNone(item)
         
     def test_parse_newspaper_item_alternative_formats(self):
         """Test various date format variations"""
-        updater = NewspaperUpdater()
+        updater = self.updater
         test_cases = [
             ('<li><a href="/zpravodaj2024_01.pdf">Ořechovský zpravodaj leden 2024</a></li>', (2024, 1)),
             ('<li><a href="/zpravodaj2024_01.pdf">Ořechovský zpravodaj ledna 2024</a></li>', (2024, 1)),
@@ -133,47 +111,49 @@ class TestNewspapers(unittest.TestCase):
         ]
         
         for html, expected in test_cases:
-            soup = BeautifulSoup(html, 'html.parser')
-            item = updater._parse_newspaper_item(soup.li)
-            
-            self.assertIsNotNone(item, f"Failed to parse: {html}")
-            self.assertEqual(item.year, expected[0], f"Wrong year for: {html}")
-            self.assertEqual(item.release, expected[1], f"Wrong release for: {html}")
+            with self.subTest(html=html):
+                li = lxml.html.fromstring(html)
+                item = updater._parse_newspaper_item(li)
+                
+                self.assertIsNotNone(item)
+                self.assertEqual(item.year, expected[0])
+                self.assertEqual(item.release, expected[1])
 
     def test_parse_newspaper_item_invalid_month(self):
         """Test invalid month names"""
-        updater = NewspaperUpdater()
-        soup = BeautifulSoup('<li><a href="/zpravodaj2024_01.pdf">Ořechovský zpravodaj - invalidmonth 2024</a></li>', 'html.parser')
-        item = updater._parse_newspaper_item(soup.li)
+        updater = self.updater
+        li = lxml.html.fromstring('<li><a href="/zpravodaj2024_01.pdf">Ořechovský zpravodaj - invalidmonth 2024</a></li>')
+        item = updater._parse_newspaper_item(li)
         
         self.assertIsNone(item)
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_fetch_newspapers_empty_response(self, mock_get):
         """Test handling of empty response from website"""
         mock_response = Mock()
-        mock_response.text = ""
-        mock_response.encoding = 'utf-8'
+        mock_response.iter_content.return_value = [b""]
         mock_get.return_value = mock_response
 
-        updater = NewspaperUpdater()
+        updater = self._create_updater(self.mock_config)
         results = updater.fetch_newspapers()
 
         self.assertIsNone(results)
 
-    @patch('requests.get')
-    def test_fetch_newspapers_encoding(self, mock_get):
-        """Test handling of different text encodings"""
+    @patch('requests.Session.get')
+    def test_fetch_newspapers_configured_encoding(self, mock_get):
+        """Test that page is decoded with encoding from configuration"""
         mock_response = Mock()
-        mock_response.text = '<li><a href="/zpravodaj2024_01.pdf">Ořechovský zpravodaj 1/2024</a></li>'
-        mock_response.encoding = 'iso-8859-2'  # Test different encoding
+        mock_response.iter_content.return_value = ['<li><a href="/zpravodaj_brezen_2023.pdf">Ořechovský zpravodaj březen 2023</a></li>'.encode('iso-8859-2')]
         mock_get.return_value = mock_response
 
-        updater = NewspaperUpdater()
+        config = self._build_mock_config()
+        config['Application']['encoding'] = 'iso-8859-2'
+        updater = self._create_updater(config)
         results = updater.fetch_newspapers()
 
         self.assertIsNotNone(results)
         self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].release, 3)
 
     @patch('firebase_admin.db.reference')
     def test_compare_and_update_no_changes(self, mock_db_ref):
@@ -183,51 +163,102 @@ class TestNewspapers(unittest.TestCase):
         
         link = "https://www.orechovubrna.cz/test.pdf"
         new_items = [
-            NewspaperItem(202401, link, 1, 2024, logging.getLogger('test'))
+            NewspaperItem.create(202401, link, 1, 2024, logging.getLogger('test'))
+        ]
+        existing_data = {
+            "202401": {"id": 202401, "year": 2024, "release": 1, "link": link}
+        }
+        
+        updater = self.updater
+        updater.compare_and_update(new_items, existing_data)
+        
+        mock_ref.update.assert_not_called()
+
+    @patch('firebase_admin.db.reference')
+    def test_compare_and_update_relative_stored_link(self, mock_db_ref):
+        """Test that another form of the same stored link is not rewritten"""
+        mock_ref = Mock()
+        mock_db_ref.return_value = mock_ref
+        
+        new_items = [
+            NewspaperItem.create(202401, "/test.pdf", 1, 2024, logging.getLogger('test'))
         ]
         existing_data = {
-            202401: {"id": 202401, "year": 2024, "release": 1, "link": link}
+            "202401": {"id": 202401, "year": 2024, "release": 1, "link": "/test.pdf"}
         }
         
-        updater = NewspaperUpdater()
+        updater = self.updater
         updater.compare_and_update(new_items, existing_data)
         
-        mock_ref.child().set.assert_not_called()
-        mock_ref.child().child().set.assert_not_called()
+        mock_ref.update.assert_not_called()
 
     def test_invalid_config_missing_required_field(self):
         """Test handling of missing required configuration fields"""
         invalid_config = self.mock_config.copy()
         del invalid_config['Application']['firebase_route']
         
-        with patch.dict(self.mock_config, invalid_config):
-            with self.assertRaises(KeyError):
-                NewspaperUpdater()
+        with self.assertRaises(KeyError):
+            self._create_updater(invalid_config)
 
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_fetch_newspapers_success(self, mock_get):
         mock_response = Mock()
-        mock_response.text = self.sample_html
-        mock_response.encoding = 'utf-8'
+        mock_response.iter_content.return_value = [self.sample_html.encode('utf-8')]
         mock_get.return_value = mock_response
 
-        updater = NewspaperUpdater()
+        updater = self._create_updater(self.mock_config)
         results = updater.fetch_newspapers()
 
         self.assertIsNotNone(results)
         self.assertEqual(len(results), 3)  # Should find 3 valid newspapers
         self.assertIsInstance(results[0], NewspaperItem)
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_fetch_newspapers_request_error(self, mock_get):
         mock_get.side_effect = requests.RequestException("Network error")
 
-        updater = NewspaperUpdater()
+        updater = self._create_updater(self.mock_config)
         results = updater.fetch_newspapers()
 
         self.assertIsNone(results)
 
+    @patch('requests.Session.get')
+    def test_fetch_newspapers_not_modified(self, mock_get):
+        """Test that unchanged page is not parsed again"""
+        mock_response = Mock()
+        mock_response.status_code = 304
+        mock_get.return_value = mock_response
+
+        updater = self._create_updater(self.mock_config)
+        state = {'etag': '"abc"', 'last_modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+        with patch.object(updater, '_load_sync_state', return_value=state):
+            results = updater.fetch_newspapers()
+
+        self.assertIs(results, NOT_MODIFIED)
+        self.assertEqual(mock_get.call_args.kwargs['headers'], {
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'
+        })
+        mock_response.iter_content.assert_not_called()
+
+    def test_update_skips_database_when_items_unchanged(self):
+        """Test that database is not touched when scraped newspapers match last synchronization"""
+        new_items = [
+            NewspaperItem.create(202401, "test.pdf", 1, 2024, logging.getLogger('test'))
+        ]
+        updater = self.updater
+        state = {'items_digest': updater._items_digest(new_items)}
+
+        with patch.object(updater, 'fetch_newspapers', return_value=new_items), \
+                patch.object(updater, '_load_sync_state', return_value=state), \
+                patch.object(updater, '_save_sync_state') as mock_save, \
+                patch.object(updater, 'get_existing_data') as mock_get_existing:
+            updater.update()
+
+        mock_get_existing.assert_not_called()
+        mock_save.assert_called_once()
+
     def test_get_existing_data_success(self):
         mock_ref = Mock()
         mock_ref.get.return_value = {
@@ -236,19 +267,19 @@ class TestNewspapers(unittest.TestCase):
         }
 
         with patch('firebase_admin.db.reference', return_value=mock_ref):
-            updater = NewspaperUpdater()
+            updater = self.updater
             data = updater.get_existing_data()
 
             self.assertEqual(len(data), 2)
-            self.assertIn(202401, data)
-            self.assertIn(202312, data)
+            self.assertIn("202401", data)
+            self.assertIn("202312", data)
 
     def test_get_existing_data_empty(self):
         mock_ref = Mock()
         mock_ref.get.return_value = None
 
         with patch('firebase_admin.db.reference', return_value=mock_ref):
-            updater = NewspaperUpdater()
+            updater = self.updater
             data = updater.get_existing_data()
 
             self.assertEqual(data, {})
@@ -259,15 +290,16 @@ class TestNewspapers(unittest.TestCase):
         mock_db_ref.return_value = mock_ref
         
         new_items = [
-            NewspaperItem(202401, "test.pdf", 1, 2024, logging.getLogger('test'))
+            NewspaperItem.create(202401, "test.pdf", 1, 2024, logging.getLogger('test'))
         ]
         existing_data = {}
         
-        updater = NewspaperUpdater()
+        updater = self.updater
         updater.compare_and_update(new_items, existing_data)
         
-        mock_ref.child.assert_called_with("202401")
-        mock_ref.child().set.assert_called_once()
+        mock_ref.update.assert_called_once_with({
+            "202401": {"id": 202401, "link": "https://www.orechovubrna.cz/test.pdf", "release": 1, "year": 2024}
+        })
 
     @patch('firebase_admin.db.reference')
     def test_compare_and_update_modified_link(self, mock_db_ref):
@@ -276,19 +308,42 @@ class TestNewspapers(unittest.TestCase):
         
         # Use complete URL in new_items
         new_items = [
-            NewspaperItem(202401, "new_link.pdf", 1, 2024, logging.getLogger('test'))
+            NewspaperItem.create(202401, "new_link.pdf", 1, 2024, logging.getLogger('test'))
         ]
         existing_data = {
-            202401: {"id": 202401, "year": 2024, "release": 1, "link": "https://www.orechovubrna.cz/old_link.pdf"}
+            "202401": {"id": 202401, "year": 2024, "release": 1, "link": "https://www.orechovubrna.cz/old_link.pdf"}
         }
         
-        updater = NewspaperUpdater()
+        updater = self.updater
         updater.compare_and_update(new_items, existing_data)
         
-        mock_ref.child.assert_called_with("202401")
-        mock_ref.child().child.assert_called_with("link")
         # Test with complete URL
-        mock_ref.child().child().set.assert_called_with("https://www.orechovubrna.cz/new_link.pdf")
+        mock_ref.update.assert_called_once_with({"202401/link": "https://www.orechovubrna.cz/new_link.pdf"})
+
+    @patch('firebase_admin.db.reference')
+    def test_compare_and_update_mixed_changes(self, mock_db_ref):
+        """Test that link changes and new items are written in one update, unchanged items are left out"""
+        mock_ref = Mock()
+        mock_db_ref.return_value = mock_ref
+        
+        logger = logging.getLogger('test')
+        new_items = [
+            NewspaperItem.create(202401, "new_link.pdf", 1, 2024, logger),
+            NewspaperItem.create(202402, "same.pdf", 2, 2024, logger),
+            NewspaperItem.create(202403, "added.pdf", 3, 2024, logger)
+        ]
+        existing_data = {
+            "202401": {"link": "https://www.orechovubrna.cz/old_link.pdf"},
+            "202402": {"link": "https://www.orechovubrna.cz/same.pdf"}
+        }
+        
+        updater = self.updater
+        updater.compare_and_update(new_items, existing_data)
+        
+        mock_ref.update.assert_called_once_with({
+            "202401/link": "https://www.orechovubrna.cz/new_link.pdf",
+            "202403": {"id": 202403, "link": "https://www.orechovubrna.cz/added.pdf", "release": 3, "year": 2024}
+        })
 
     def test_newspaper_item_validation(self):
         """Test NewspaperItem validation with various inputs"""
@@ -300,20 +355,20 @@ class TestNewspapers(unittest.TestCase):
         logger.setLevel(logging.ERROR)
         
         # Test valid input
-        item = NewspaperItem(202401, "test.pdf", 1, 2024, logger)
+        item = NewspaperItem.create(202401, "test.pdf", 1, 2024, logger)
         self.assertEqual(item.id, 202401)
         
         # Test invalid year
         with self.assertRaises(ValueError):
-            NewspaperItem(202401, "test.pdf", 1, 2050, logger)
+            NewspaperItem.create(202401, "test.pdf", 1, 2050, logger)
         
         # Test invalid release number
         with self.assertRaises(ValueError):
-            NewspaperItem(202413, "test.pdf", 13, 2024, logger)
+            NewspaperItem.create(202413, "test.pdf", 13, 2024, logger)
         
         # Test invalid link format
         with self.assertRaises(ValueError):
-            NewspaperItem(202401, "test.doc", 1, 2024, logger)
+            NewspaperItem.create(202401, "test.doc", 1, 2024, logger)
         
         # Clean up
         logger.removeHandler(handler)
@@ -324,26 +379,24 @@ class TestNewspapers(unittest.TestCase):
             with self.assertRaises(FileNotFoundError):
                 NewspaperUpdater('nonexistent/config.txt')
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_fetch_newspapers_no_valid_items(self, mock_get):
         mock_response = Mock()
-        mock_response.text = "<ul><li><a href='/other.pdf'>Not a newspaper</a></li></ul>"
-        mock_response.encoding = 'utf-8'
+        mock_response.iter_content.return_value = [b"<ul><li><a href='/other.pdf'>Not a newspaper</a></li></ul>"]
         mock_get.return_value = mock_response
 
-        updater = NewspaperUpdater()
+        updater = self._create_updater(self.mock_config)
         results = updater.fetch_newspapers()
 
         self.assertIsNone(results)
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_fetch_newspapers_malformed_html(self, mock_get):
         mock_response = Mock()
-        mock_response.text = "Invalid HTML content"
-        mock_response.encoding = 'utf-8'
+        mock_response.iter_content.return_value = [b"Invalid HTML content"]
         mock_get.return_value = mock_response
 
-        updater = NewspaperUpdater()
+        updater = self._create_updater(self.mock_config)
         results = updater.fetch_newspapers()
 
         self.assertIsNone(results)
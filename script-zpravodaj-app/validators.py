@@ -2,32 +2,56 @@ from typing import Optional, Tuple, Any
 import logging
 import re
 from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit
+
+# Sync scripts are short-lived, so the upper bound for a valid year is resolved once per run
+_CURRENT_YEAR = datetime.now().year
+
+# Checks for valid URL format, also allows Czech characters, spaces and common URL characters
+_URL_RE = re.compile(r'^https?://[a-zA-Z0-9\u00C0-\u017F\-._~:/\?#\[\]@!$&\'\(\)\*\+,;=\%\s]+$')
+
+# Relative links on the municipal website are resolved against this prefix
+_SITE_PREFIX = 'https://www.orechovubrna.cz'
+
+def _absolute_link(link: str) -> str:
+    # Resolves relative links against the website, absolute links are only stripped
+    link = link.strip()
+    if not link.startswith(('http://', 'https://')):
+        if not link.startswith('/'):
+            link = '/' + link
+        link = _SITE_PREFIX + link
+    return link
 
 def validate_link(link: Optional[str], logger: Optional[logging.Logger] = None):
     if not link:
         if logger:
             logger.error("Empty link provided")
-        return None, None
+        return None
         
-    link = link.strip()
-    if not link.startswith(('http://', 'https://')):
-        if not link.startswith('/'):
-            link = '/' + link
-        link = 'https://www.orechovubrna.cz' + link
+    link = _absolute_link(link)
         
     if not link.lower().endswith('.pdf'):
         if logger:
             logger.error(f"Link does not point to a PDF file: {link}")
         return None
     
-    # Checks for valid URL format, also allows Czech characters, spaces and common URL characters
-    if not re.match(r'^https?://[a-zA-Z0-9\u00C0-\u017F\-._~:/\?#\[\]@!$&\'\(\)\*\+,;=\%\s]+$', link):
+    if not _URL_RE.match(link):
         if logger:
             logger.error(f"Invalid URL format: {link}")
         return None
     
     return link
 
+def canonical_link(link: Optional[str]) -> Optional[str]:
+    # Canonical form of a link, relative and absolute forms of the same link are equal after it
+    if not link:
+        return link
+    
+    link = _absolute_link(link)
+    parts = urlsplit(link)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'),
+                       parts.query, parts.fragment))
+
 def validate_release(release: Any, logger: Optional[logging.Logger] = None):
     try:
         release_num = int(release)
@@ -44,10 +68,9 @@ def validate_release(release: Any, logger: Optional[logging.Logger] = None):
 def validate_year(year: Any, logger: Optional[logging.Logger] = None):
     try:
         year_num = int(year)
-        current_year = datetime.now().year
-        if not 1970 <= year_num <= current_year:
+        if not 1970 <= year_num <= _CURRENT_YEAR:
             if logger:
-                logger.error(f"Year out of valid range (1990-{current_year}): {year_num}")
+                logger.error(f"Year out of valid range (1970-{_CURRENT_YEAR}): {year_num}")
             return None
         return year_num
     except (ValueError, TypeError):
@@ -67,4 +90,21 @@ def validate_id(id: Any, year: int, release: int, logger: Optional[logging.Logge
     except Exception:
         if logger:
             logger.error(f"Invalid ID format: {id}")
-        return None
\ No newline at end of file
+        return None
+
+def validate_item(id: Any, year: Any, release: Any, link: Optional[str], logger: Optional[logging.Logger] = None) -> Tuple[int, int, int, str]:
+    # Validates all fields of a newspaper, raises ValueError for the first invalid field
+    year_num = validate_year(year, logger)
+    release_num = validate_release(release, logger)
+    if year_num is None or release_num is None:
+        raise ValueError("Invalid year or release number")
+
+    id_num = validate_id(id, year_num, release_num, logger)
+    if id_num is None:
+        raise ValueError("Invalid ID format")
+
+    validated_link = validate_link(link, logger)
+    if validated_link is None:
+        raise ValueError("Invalid link format or not a PDF file")
+
+    return year_num, release_num, id_num, validated_link
\ No newline at end of file
@@ -11,18 +11,25 @@ sys.path.insert(0, app_dir)
 venv_site_packages = os.path.join(app_dir, 'venv', 'lib', 'python3.8', 'site-packages')
 sys.path.insert(0, venv_site_packages)
 
-# Load environment variables
-try:
-    from dotenv import load_dotenv
-    env_path = os.path.join(app_dir, '.env')
-    load_dotenv(env_path)
-except ImportError:
-    if os.path.exists(os.path.join(app_dir, '.env')):
-        with open(os.path.join(app_dir, '.env')) as f:
-            for line in f:
-                if line.strip() and not line.startswith('#'):
-                    key, value = line.strip().split('=', 1)
-                    os.environ[key] = value.strip("'").strip('"')
+def _load_environment():
+    # Load environment variables
+    try:
+        from dotenv import load_dotenv
+        env_path = os.path.join(app_dir, '.env')
+        load_dotenv(env_path)
+    except ImportError:
+        if os.path.exists(os.path.join(app_dir, '.env')):
+            with open(os.path.join(app_dir, '.env')) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    key, sep, value = line.partition('=')
+                    if not sep:
+                        continue
+                    os.environ[key] = value.strip("'\"")
+
+_load_environment()
 
 # Import the Flask application
 from app import app as application